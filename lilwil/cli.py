@@ -1,8 +1,9 @@
 import typing, sys, signal
 from io import StringIO
+from functools import partial
 
 from .common import Event, run_test, open_file, load_parameters, import_library
-from .common import ExitStack, test_indices, parametrized_indices
+from .common import ExitStack, InfoCache, test_indices, parametrized_indices
 
 ################################################################################
 
@@ -31,6 +32,7 @@ def parser(prog='lilwil', lib='', suite='lilwil', jobs=1, description='Run C++ u
     o(p, str, 'STR', '--params', '-p', action='append', help='JSON file for all parameters (in {"name": [packs...], ...} form; may be specified multiple times)')
     s(p, '--gil',                '-g', help='keep Python global interpeter lock on')
     s(p, '--no-signal',                help='prevent catching SIGINT signal')
+    s(p, '--process-pool',             help='run jobs in worker processes rather than threads (needs --jobs > 0)')
     o(p, str, '', 'tests', nargs='*',  help='test names (if not given, specifies all tests that can be run without any user-specified parameters)')
 
     r = p.add_argument_group('reporter options')
@@ -59,10 +61,10 @@ def parser(prog='lilwil', lib='', suite='lilwil', jobs=1, description='Run C++ u
 
 ################################################################################
 
-def run_index(lib, masks, out, err, gil, cout, cerr, p):
+def run_index(lib, infos, masks, out, err, gil, cout, cerr, p):
     '''Run test at given index, return (1, time, *counts)'''
     i, args = p
-    info = lib.test_info(i)
+    info = infos[i]
     test_masks = [(r(i, args, info), m) for r, m in masks]
     val, time, counts = run_test(lib, i, test_masks, out=out, err=err,
         args=args, gil=gil, cout=cout, cerr=cerr)
@@ -70,6 +72,94 @@ def run_index(lib, masks, out, err, gil, cout, cerr, p):
 
 ################################################################################
 
+_worker_lib = None
+
+def init_worker(lib, signals):
+    '''
+    Set up a process pool worker forked from the process which imported lib
+    The worker uses the inherited module so that tests and values added to it
+    at runtime are kept. A terminal SIGINT reaches the workers as well, so if
+    signals are handled they set the signal in lib like the main process does.
+    '''
+    global _worker_lib
+    _worker_lib = lib
+    signal.signal(signal.SIGINT, Interrupt(lib, True) if signals else signal.SIG_IGN)
+
+def record_index(gil, cout, cerr, mask, p):
+    '''
+    Run test at given index in a process pool worker, recording the events in mask
+    Return (index, args, events, value, time, counts, out, err)
+    '''
+    i, args = p
+    events = []
+    record = lambda event, scopes, logs: events.append((event, scopes, logs))
+    reports = tuple(record if m else None for m in mask)
+    return (i, args, events) + tuple(_worker_lib.run_test(i, reports, args, gil, cout, cerr))
+
+def replay_index(lib, infos, masks, out, err, result):
+    '''Replay a test recorded by record_index() into the reports, return (1, time, *counts)'''
+    i, args, events, val, time, counts, o, e = result
+    info = infos[i]
+    test_masks = [(r(i, args, info), m) for r, m in masks]
+    with ExitStack() as stack:
+        for r, _ in test_masks:
+            stack.enter_context(r)
+        for event, scopes, logs in events:
+            for r, m in test_masks:
+                if event < len(m) and m[event]:
+                    r(event, scopes, logs)
+        if out is not None:
+            out.write(o)
+        if err is not None:
+            err.write(e)
+        for r, _ in test_masks:
+            r.finalize(val, time, counts, o, e)
+    return (1, time) + tuple(counts)
+
+def map_chunk(f, items):
+    '''Return list of f(item) for each of items, e.g. to run a chunk of tests as one task'''
+    return list(map(f, items))
+
+def imap_executor(executor, f, iterable, chunksize=1, window=1):
+    '''
+    Yield f(item) for each item in iterable, run by a concurrent.futures executor
+    Items are submitted in chunks with at most window chunks pending at once, so
+    iterable is consumed lazily. Results are yielded as their chunks finish.
+    '''
+    import itertools
+    from concurrent.futures import wait, FIRST_COMPLETED
+    iterator, pending = iter(iterable), set()
+    try:
+        while True:
+            while len(pending) < window:
+                chunk = list(itertools.islice(iterator, chunksize))
+                if not chunk:
+                    break
+                pending.add(executor.submit(map_chunk, f, chunk))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+################################################################################
+
+# Largest chunk of tests handed to a pool worker at once when the queue is bounded
+MAX_CHUNKSIZE = 16
+
+def bounded(iterable, semaphore, stop):
+    '''Yield from iterable, acquiring semaphore before each item, until stop is set'''
+    for item in iterable:
+        semaphore.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+################################################################################
+
 class Interrupt:
     def __init__(self, lib, active):
         self.active = active
@@ -90,25 +180,65 @@ class Interrupt:
 
 ################################################################################
 
-def run_suite(lib, keypairs, masks, gil, cout, cerr, signals, exe=map):
-    '''Run a subset of tests'''
-    out, err = StringIO(), StringIO()
+def run_suite(lib, keypairs, masks, gil, cout, cerr, signals, exe=map, pool=None, bound=None):
+    '''
+    Run a subset of tests
+        exe: map-like function used to run tests in this process
+        pool: if given, map-like function used to run tests in worker processes
+            initialized by init_worker(). Events are then recorded in the workers
+            and replayed into the reports in this process.
+        bound: if given, maximum number of tests handed to exe but not yet finished
+    '''
+    out = StringIO() if cout else None
+    err = StringIO() if cerr else None
+    infos = InfoCache(lib)
     interrupt = Interrupt(lib, signals)
     def f(p):
         if not interrupt.was_interrupted:
-            return run_index(lib, masks, out, err, gil, cout, cerr, p)
+            return run_index(lib, infos, masks, out, err, gil, cout, cerr, p)
+
+    stop = None
+    if bound is not None and pool is None:
+        import threading
+        semaphore, stop, run_one = threading.Semaphore(bound), threading.Event(), f
+        keypairs = bounded(keypairs, semaphore, stop)
+        def f(p):
+            try:
+                return run_one(p)
+            finally:
+                semaphore.release()
+
+    def replay(results):
+        for result in results:
+            if interrupt.was_interrupted:
+                return
+            yield replay_index(lib, infos, masks, out, err, result)
 
     with interrupt:
+        if pool is None:
+            results = exe(f, keypairs)
+        else:
+            mask = tuple(any(e < len(m) and m[e] for _, m in masks) for e in range(len(Event)))
+            results = replay(pool(partial(record_index, gil, cout, cerr, mask), keypairs))
+
         output = [0] * (len(Event) + 2)
-        for result in exe(f, keypairs):
-            if result is None:
-                break
-            output = [(o + r) for o, r in zip(output, result)]
+        try:
+            for result in results:
+                if result is None:
+                    break
+                output = [(o + r) for o, r in zip(output, result)]
+        finally:
+            # a raising test makes the pool skip the rest of its chunk without
+            # releasing their permits: stop the generator and wake it up instead
+            if stop is not None:
+                stop.set()
+                semaphore.release()
 
         n, time, *counts = output
 
         for r, _ in masks:
-            r.finalize(n, time, counts, out.getvalue(), err.getvalue())
+            r.finalize(n, time, counts, '' if out is None else out.getvalue(),
+                       '' if err is None else err.getvalue())
 
     if interrupt.was_interrupted:
         import sys
@@ -124,9 +254,14 @@ def main(run=run_suite, lib='libwil', string=None, no_default=False, failure=Fal
     quiet=False, capture=False, gil=False, exclude=False, no_color=False,
     regex=None, out='stdout', out_mode='w', xml=None, xml_mode='a+b', suite='lilwil',
     teamcity=None, json=None, json_indent=None, jobs=0, tests=None, indices=None,
-    args=None, params=None, skip=False, no_sync=None, no_signal=False):
+    args=None, params=None, skip=False, no_sync=None, no_signal=False, process_pool=False):
     '''Main non-argparse function for running a subset of lilwil tests with given options'''
 
+    if process_pool and run is not run_suite:
+        raise ValueError('process pool is only supported by run_suite')
+    if process_pool and not jobs:
+        raise ValueError('process pool requires a positive number of jobs')
+
     lib = import_library(lib)
     if isinstance(indices, str):
         if ':' in indices:
@@ -136,12 +271,14 @@ def main(run=run_suite, lib='libwil', string=None, no_default=False, failure=Fal
 
     names = lib.test_names()
     indices = test_indices(names, exclude=exclude, tests=tests, regex=regex, indices=indices)
-    keypairs = tuple(parametrized_indices(lib, indices, load_parameters(args, params, string)))
+    keypairs = parametrized_indices(lib, indices, load_parameters(args, params, string))
 
     if list:
+        keypairs = tuple(keypairs)
         fmt = '%{}d: %s'.format(len(str(len(names))))
+        infos = InfoCache(lib)
         for k in keypairs:
-            print(fmt % (k[0], lib.test_info(k[0])[0]))
+            print(fmt % (k[0], infos[k[0]][0]))
         print('\n(%d total tests)' % len(keypairs))
         return
 
@@ -176,14 +313,42 @@ def main(run=run_suite, lib='libwil', string=None, no_default=False, failure=Fal
             r = NativeReport(open_file(stack, json, 'w'), info, indent=json_indent)
             masks.append((stack.enter_context(r), mask))
 
-        if jobs:
+        kws = {}
+        # keypairs are generated lazily, so the number of tests stands in for their count
+        chunksize = max(1, len(indices) // (jobs * 4 or 1))
+        if process_pool:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # workers must inherit lib rather than import it again
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise ValueError('process pool requires the fork start method, which is not available')
+            executor = ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork'),
+                initializer=init_worker, initargs=(lib, not no_signal))
+            if sys.version_info >= (3, 9):
+                stack.callback(executor.shutdown, cancel_futures=True)
+            else:
+                stack.callback(executor.shutdown)
+            # as with threads, only a few small chunks per worker are submitted at once
+            chunksize = min(chunksize, MAX_CHUNKSIZE)
+            kws['pool'] = lambda f, it: imap_executor(executor, f, it, chunksize, window=2 * jobs)
+            exe = map
+        elif jobs:
             from multiprocessing.pool import ThreadPool
-            exe = ThreadPool(jobs).imap # .imap() is in order, .map() is not
+            pool = stack.enter_context(ThreadPool(jobs))
+            # the chunks are kept small so that the bound depends on jobs, not on the number of tests
+            chunksize = min(chunksize, MAX_CHUNKSIZE)
+            # reports are called from the pool threads, so results can be summed in any order
+            exe = lambda f, it: pool.imap_unordered(f, it, chunksize=chunksize)
+            # keep the pool from queueing every test up front (must be at least a chunk)
+            kws['bound'] = 2 * jobs * chunksize
         else:
             exe = map
 
-        return run(lib=lib, keypairs=keypairs, masks=masks,
-            gil=gil, cout=capture, cerr=capture, signals=not no_signal, exe=exe)
+        if run is not run_suite: # keep the original contract for custom runners
+            keypairs, kws = tuple(keypairs), {}
+
+        return run(lib=lib, keypairs=keypairs, masks=masks, gil=gil, cout=capture,
+            cerr=capture, signals=not no_signal, exe=exe, **kws)
 
 
 def exit_main(no_color=False, **kwargs):
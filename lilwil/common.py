@@ -1,4 +1,4 @@
-import os, json, sys, io, enum, typing, importlib, signal
+import os, json, sys, enum, typing, importlib, signal
 from collections import defaultdict
 
 try:
@@ -32,13 +32,12 @@ class Event(enum.IntEnum):
         except IndexError:
             return str(i)
 
-Event.names = ('Failure', 'Success', 'Exception', 'Timing', 'Skipped')
+# Plain tuple of event names, indexable directly by the integer event code
+EVENT_NAMES = ('Failure', 'Success', 'Exception', 'Timing', 'Skipped')
 
-################################################################################
+Event.names = EVENT_NAMES
 
-def foreach(function, *args):
-    '''Run function on each positional argument in sequence'''
-    return tuple(map(function, args))
+N_EVENTS = len(EVENT_NAMES)
 
 ################################################################################
 
@@ -55,17 +54,6 @@ class Report:
 
 ################################################################################
 
-def pop_value(key, keys, values, default=None):
-    '''Pop value from values at the index where key is in keys'''
-    try:
-        idx = keys.index(key)
-        keys.pop(idx)
-        return values.pop(idx)
-    except ValueError:
-        return default
-
-################################################################################
-
 def import_library(lib, name=None):
     '''
     Import a module from a given shared library file name
@@ -108,9 +96,12 @@ def test_indices(names, indices=None, exclude=False, tests=None, regex='', stric
     '''
     out = set()
     if tests: # manually specified tests
+        lookup = {}
+        for i, n in enumerate(names):
+            lookup.setdefault(n, i) # first occurrence, like names.index()
         for t in tests:
-            if t in names:
-                out.add(names.index(t))
+            if t in lookup:
+                out.add(lookup[t])
             elif strict:
                 raise KeyError('Manually specified test %r is not in the test suite' % t) from None
             else:
@@ -121,8 +112,8 @@ def test_indices(names, indices=None, exclude=False, tests=None, regex='', stric
 
     if regex:
         import re
-        pattern = re.compile(regex)
-        out.update(i for i, t in enumerate(names) if pattern.match(t))
+        match = re.compile(regex).match
+        out.update(i for i, t in enumerate(names) if match(t))
 
     if indices:
         for i in indices:
@@ -133,7 +124,7 @@ def test_indices(names, indices=None, exclude=False, tests=None, regex='', stric
         out = set(range(len(names)))
 
     if exclude:
-        out = set(range(len(names))).difference(out)
+        return [i for i in range(len(names)) if i not in out]
     return sorted(out)
 
 
@@ -224,6 +215,17 @@ def parametrized_indices(lib, indices, params=(None,)):
 
 ################################################################################
 
+class InfoCache(dict):
+    '''Memoized lib.test_info() lookups keyed by test index'''
+    def __init__(self, lib):
+        self.lib = lib
+
+    def __missing__(self, index):
+        info = self[index] = self.lib.test_info(index)
+        return info
+
+################################################################################
+
 class MultiReport:
     '''Simple wrapper to call multiple reports from C++ as if they are one'''
     def __init__(self, reports):
@@ -252,17 +254,17 @@ def run_test(lib, index, test_masks, out=None, err=None, args=(), gil=False, cou
         gil: keep GIL on
         cout, cerr: capture std::cout, std::cerr
     '''
-    lists = [[] for _ in Event]
-
     with ExitStack() as stack:
-        for r, mask in test_masks:
+        for r, _ in test_masks:
             stack.enter_context(r)
-            [l.append(r) for m, l in zip(mask, lists) if m]
-        reports = tuple(map(multireport, lists))
+        reports = tuple(multireport([r for r, mask in test_masks if e < len(mask) and mask[e]])
+                        for e in range(N_EVENTS))
 
         val, time, counts, o, e = lib.run_test(index, reports, args, gil, cout, cerr)
-        out.write(o)
-        err.write(e)
+        if out is not None:
+            out.write(o)
+        if err is not None:
+            err.write(e)
         for r, _ in test_masks:
             r.finalize(val, time, counts, o, e)
         return val, time, counts
@@ -270,44 +272,79 @@ def run_test(lib, index, test_masks, out=None, err=None, args=(), gil=False, cou
 
 ################################################################################
 
-def readable_header(keys, values, kind, scopes):
+# Logged keys which are formatted specially rather than as "key: value"
+SPECIAL_KEYS = ('__file', '__line', '__comment', '__lhs', '__op', '__rhs')
+COMPARISON_KEYS = ('__lhs', '__op', '__rhs')
+
+def split_logs(logs):
+    '''
+    Split logged key value pairs, usually in a single pass
+    Return (dict of key to list of values for each of SPECIAL_KEYS, list of other pairs)
+    Special pairs which cannot be formatted specially are kept in the other
+    pairs at their logged position: a line without a file, and the values
+    beyond the number of complete comparisons.
+    '''
+    fields = {k: [] for k in SPECIAL_KEYS}
+    other = []
+    for k, v in logs:
+        values = fields.get(k)
+        if values is None:
+            other.append((k, v))
+        else:
+            values.append(v)
+
+    n = min(len(fields[k]) for k in COMPARISON_KEYS)
+    # number of leading values of each key which are formatted specially
+    used = {k: n for k in COMPARISON_KEYS if len(fields[k]) > n}
+    if fields['__line'] and not fields['__file']:
+        used['__line'] = 0
+    if used:
+        other = []
+        for k, v in logs:
+            if k in used:
+                if used[k]:
+                    used[k] -= 1
+                else:
+                    other.append((k, v))
+            elif k not in fields:
+                other.append((k, v))
+    return fields, other
+
+################################################################################
+
+def readable_header(fields, kind, scopes):
     '''Return string with basic event information'''
-    kind = Event.name(kind) if isinstance(kind, int) else kind
+    if isinstance(kind, int):
+        kind = EVENT_NAMES[kind] if kind < len(EVENT_NAMES) else str(kind)
     scopes = repr(DELIMITER.join(scopes))
 
-    if '__file' in keys:
-        while '__line' in keys:
-            line = pop_value('__line', keys, values)
-        while '__file' in keys:
-            path = pop_value('__file', keys, values)
-    else:
+    paths, lines = fields['__file'], fields['__line']
+    if not paths:
         return '{}: {}\n'.format(kind, scopes)
-    desc = '({})'.format(path) if line is None else '({}:{})'.format(path, line)
+    desc = '({}:{})'.format(paths[-1], lines[-1]) if lines else '({})'.format(paths[-1])
     return '{}: {} {}\n'.format(kind, scopes, desc)
 
 ################################################################################
 
-def readable_logs(keys, values, indent):
+def readable_logs(fields, other, indent):
     '''Return readable string of key value pairs'''
-    s = io.StringIO()
-    while '__comment' in keys: # comments
-        foreach(s.write, indent, 'comment: ', pop_value('__comment', keys, values), '\n')
+    parts = []
+    for c in fields['__comment']: # comments
+        parts.append('{}comment: {}\n'.format(indent, c))
 
-    comp = ('__lhs', '__op', '__rhs') # comparisons
-    while all(map(keys.__contains__, comp)):
-        lhs, op, rhs = (pop_value(k, keys, values) for k in comp)
-        foreach(s.write, indent, 'required: {} {} {}\n'.format(lhs, op, rhs))
+    for lhs, op, rhs in zip(*(fields[k] for k in COMPARISON_KEYS)): # comparisons
+        parts.append('{}required: {} {} {}\n'.format(indent, lhs, op, rhs))
 
-    for k, v in zip(keys, values): # all other logged keys and values
-        foreach(s.write, indent, (k + ': ' if k else 'info: '), str(v), '\n')
-    return s.getvalue()
+    for k, v in other: # all other logged keys and values
+        parts.append('{}{}: {}\n'.format(indent, k or 'info', v))
+    return ''.join(parts)
 
 ################################################################################
 
 def readable_message(kind, scopes, logs, indent='    '):
     '''Return readable string for a C++ lilwil callback'''
-    keys, values = map(list, zip(*logs)) if logs else ((), ())
-    return readable_header(keys, values, kind, scopes) + readable_logs(keys, values, indent)
+    fields, other = split_logs(logs)
+    return readable_header(fields, kind, scopes) + readable_logs(fields, other, indent)
 
 ################################################################################
 
@@ -1,5 +1,5 @@
 import io, sys, typing, datetime
-from .common import Report, readable_message, Event
+from .common import Report, readable_message, EVENT_NAMES
 
 ################################################################################
 
@@ -27,10 +27,11 @@ class Colorer:
         self.stdout = self.colored('Contents of std::cout', 'magenta')
         self.test_duration = self.colored('Test duration', 'yellow')
         self.total_duration = self.colored('Total duration', 'yellow')
+        self._events = [self.colored(m, c) for m, c in zip(EVENT_NAMES, self.event_colors)]
 
     def events(self):
         '''Return list of string of representation for each Event'''
-        return [self.colored(m, c) for m, c in zip(map(Event.name, Event), self.event_colors)]
+        return self._events
 
     def test_name(self, index):
         '''Format a test index message'''
@@ -57,30 +58,31 @@ class ConsoleReport(Report):
             color=self.color, timing=self.timing, sync=self.sync)
 
     def finalize(self, n, time, counts, out, err):
-        s = self.color.footer + 'Total results for {} test{}:\n'.format(n, '' if n == 1 else 's')
+        parts = [self.color.footer, 'Total results for {} test{}:\n'.format(n, '' if n == 1 else 's')]
 
         spacing = max(map(len, self.events)) + 1
-        for e, c in zip(self.events, counts):
-            s += self.color.indent + '{} {}\n'.format((e + ':').ljust(spacing), c)
+        parts.extend(self.color.indent + '{} {}\n'.format((e + ':').ljust(spacing), c)
+                     for e, c in zip(self.events, counts))
 
         if self.timing:
-            if self.color.footer: s += '\n'
-            s += self.color.total_duration + ': %.7e\n' % time
+            if self.color.footer: parts.append('\n')
+            parts.append(self.color.total_duration + ': %.7e\n' % time)
 
-        self.file.write(s)
+        self.file.write(''.join(parts))
+        self.file.flush()
 
     def __exit__(self, value, cls, traceback):
         self.file.write(self.color.footer)
+        self.file.flush()
 
 ################################################################################
 
 class ConsoleTestReport(Report):
     def __init__(self, index, args, info, file, events, color, timing=False, sync=False):
         self.color, self.timing, self.events = color, timing, events
-        if sync:
-            self.file, self.output = io.StringIO(), file
-        else:
-            self.file, self.output = file, None
+        self.file = file
+        # in sync mode, fragments are held until __exit__ and written all at once
+        self.buffer = [] if sync else None
 
         if info[1]:
             if args:
@@ -98,8 +100,10 @@ class ConsoleTestReport(Report):
         self.write(self.color.footer, self.color.test_name(index), s, '\n')
 
     def write(self, *args):
-        tuple(map(self.file.write, args))
-        self.file.flush()
+        if self.buffer is None:
+            self.file.write(''.join(args))
+        else:
+            self.buffer.extend(args)
 
     def __call__(self, event, scopes, logs):
         self.write('\n', readable_message(self.events[event], scopes, logs, self.color.indent))
@@ -120,8 +124,8 @@ class ConsoleTestReport(Report):
             self.write(self.color.test_duration, ': %.7e\n' % time)
 
     def __exit__(self, value, cls, traceback):
-        if self.output is not None:
-            self.output.write(self.file.getvalue())
-            self.output.flush()
+        if self.buffer is not None:
+            self.file.write(''.join(self.buffer))
+        self.file.flush()
 
 ################################################################################
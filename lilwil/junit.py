@@ -1,6 +1,10 @@
-from .common import readable_message, Report
+from .common import readable_message, Report, Event
 import xml.etree.ElementTree as ET
-import io, datetime
+import io, datetime, tempfile, shutil, threading
+
+# plain ints for comparison in the per-event path
+_FAILURE = int(Event.failure)
+_EXCEPTION = int(Event.exception)
 
 ################################################################################
 
@@ -48,43 +52,101 @@ class XMLReport(Report):
 ################################################################################
 
 class XMLFileReport(XMLReport):
-    def __init__(self, file, *args, **kwargs):
+    '''
+    XML report written to a file. Each test case is serialized as soon as it
+    finishes into a temporary file, which is spliced into the document on exit.
+    '''
+    MARKER = b'<!--lilwil-testcases-->'
+
+    END = b'</testsuites>'
+
+    def __init__(self, file, info, suite, **kwargs):
         self.file = getattr(file, 'buffer', file)
+        self.n_suites = None # set if the new suite is spliced onto the existing file
+        root = None
         try:
             self.file.seek(0)
-            root = ET.parse(self.file).getroot()
-            assert root is not None
-            self.file.seek(0)
-            self.file.truncate()
+            data = self.file.read()
+            if self.can_append(data, suite):
+                end = data.rindex(self.END)
+                self.n_suites = data.count(b'<testsuite ', 0, end)
+                self.file.seek(end)
+                self.file.truncate()
+            else:
+                root = ET.fromstring(data)
+                self.file.seek(0)
+                self.file.truncate()
         except (io.UnsupportedOperation, ET.ParseError):
-            root = None
-        super().__init__(*args, root=root, **kwargs)
+            pass
+        super().__init__(info, suite, root=root, **kwargs)
+        self.suite.append(ET.Comment(self.MARKER[4:-3].decode()))
+        self.spool = tempfile.TemporaryFile()
+        self.lock = threading.Lock()
+        self.n_cases = 0
+
+    @classmethod
+    def can_append(cls, data, suite):
+        '''
+        Return whether a suite can be added to the existing XML bytes without parsing them.
+        This requires that the bytes end with </testsuites>, that all suites
+        were written with name as their first attribute, and that none has the given name.
+        '''
+        if not data.rstrip().endswith(cls.END):
+            return False
+        tag = ET.tostring(ET.Element('testsuite', name=suite))[:-3] # <testsuite name="..."
+        return tag not in data and data.count(b'<testsuite ') == data.count(b'<testsuite name=')
+
+    def __call__(self, index, args, info):
+        return XMLTestReport(index, args, info, callback=self.write_case)
+
+    def write_case(self, case):
+        '''Serialize a finished test case to the temporary file'''
+        b = ET.tostring(case.element)
+        with self.lock:
+            self.spool.write(b)
+            self.n_cases += 1
 
     def __exit__(self, value, cls, traceback):
-        super().__exit__(value, cls, traceback)
-        for i, c in enumerate(self.root):
-            c.set('id', str(i))
-        ET.ElementTree(self.root).write(self.file, xml_declaration=True)
+        self.suite.set('tests', str(self.n_cases))
+        doc = io.BytesIO()
+        if self.n_suites is None:
+            for i, c in enumerate(self.root):
+                c.set('id', str(i))
+            ET.ElementTree(self.root).write(doc, xml_declaration=True)
+        else:
+            self.suite.set('id', str(self.n_suites))
+            ET.ElementTree(self.suite).write(doc)
+            doc.write(self.END)
+        head, _, tail = doc.getvalue().partition(self.MARKER)
+        self.file.write(head)
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.file)
+        self.spool.close()
+        self.file.write(tail)
 
 ################################################################################
 
 class XMLTestReport(Report):
-    def __init__(self, index, args, info):
+    def __init__(self, index, args, info, callback=None):
         self.element = ET.Element('testcase', name=info[0], classname=info[0])
+        self.callback = callback
         self.time = None
         self.sub = None
-        self.message = ''
+        self.messages = []
 
     def __call__(self, event, scopes, logs):
-        self.message += readable_message(event, scopes, logs)
+        self.messages.append(readable_message(event, scopes, logs))
         if self.sub is None:
-            if event == 0:
+            if event == _FAILURE:
                 self.sub = ET.SubElement(self.element, 'failure', message='', type='2')
-            if event == 2:
+            if event == _EXCEPTION:
                 self.sub = ET.SubElement(self.element, 'error', message='', type='1')
-        self.sub.set('message', self.message + readable_message(event, scopes, logs))
 
     def finalize(self, value, time, counts, out, err):
         self.element.set('time', '%f' % time)
+        if self.sub is not None:
+            self.sub.set('message', ''.join(self.messages))
+        if self.callback is not None:
+            self.callback(self)
 
 ################################################################################
@@ -1,49 +1,144 @@
-from .common import Event, Report
-import time, datetime, json
+from .common import EVENT_NAMES, N_EVENTS, Report
+import time, datetime, json, io, threading, collections
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+################################################################################
+
+def dumps(obj, indent=None):
+    '''
+    Return JSON str for obj, using orjson if it is installed and supports the indent
+    orjson output is only used if it matches the json module's: non-ASCII text
+    would not be escaped, and NaN or infinity would have been written as null.
+    '''
+    if orjson is not None and indent in (None, 2):
+        try:
+            s = orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+            if s.isascii() and b'null' not in s:
+                return s.decode()
+        except TypeError: # e.g. integers beyond 64 bits; orjson.JSONEncodeError is a TypeError
+            pass
+    if indent is None: # no whitespace is needed at all
+        return json.dumps(obj, separators=(',', ':'))
+    return json.dumps(obj, indent=indent)
+
+################################################################################
+
+def text_writer(file, buffer_size=1 << 18):
+    '''
+    Return (text file, wrappers) for writing str to file through a buffer
+    Raw files are wrapped in a BufferedWriter and binary files in a TextIOWrapper.
+    Other files are assumed to be buffered text files and are returned as is.
+    The wrappers should be detached with detach_writers() rather than closed.
+    '''
+    wrappers = []
+    if isinstance(file, io.RawIOBase):
+        file = io.BufferedWriter(file, buffer_size)
+        wrappers.append(file)
+    if isinstance(file, io.BufferedIOBase):
+        file = io.TextIOWrapper(file, encoding='utf-8')
+        wrappers.append(file)
+    return file, wrappers
+
+def detach_writers(wrappers):
+    '''Flush and detach wrappers made by text_writer() without closing the original file'''
+    for w in reversed(wrappers):
+        w.flush()
+        w.detach()
 
 ################################################################################
 
 class NativeReport(Report):
+    '''
+    JSON report. If a file is given, each test is written to it as soon as it
+    finishes rather than being kept in memory. Otherwise, the tests are kept in
+    self.contents['tests'].
+    '''
+    MARK = '__lilwil_tests__' # placeholder used to split the document around the tests
+
     def __init__(self, file, info, indent=None, keep_null=False):
-        self.file = file
+        self.file, self.wrappers = (None, ()) if file is None else text_writer(file)
         self.indent = indent
         self.keep_null = bool(keep_null)
         self.contents = {
             'compile-info': dict(name=info[0], date=info[1], time=info[2]),
             'tests': [],
         }
+        # each test is nested 2 levels deep in the document
+        self.newline = None if indent is None else '\n' + 2 * (' ' * indent if isinstance(indent, int) else indent)
+        self.lock = threading.Lock()
+        self.n_written = 0
+
+    def __enter__(self):
+        if self.file is not None:
+            doc = dumps(dict(self.contents, tests=[self.MARK] * 2), self.indent)
+            head, self.separator, _ = doc.split(json.dumps(self.MARK))
+            self.file.write(head)
+        return self
 
     def __call__(self, index, args, info):
         c = {}
-        self.contents['tests'].append(c)
-        return NativeTestReport(c, index, args, info[0])
+        if self.file is None:
+            self.contents['tests'].append(c)
+            return NativeTestReport(c, index, args, info[0])
+        return NativeTestReport(c, index, args, info[0], keep_null=self.keep_null, callback=self.write_test)
+
+    def write_test(self, contents):
+        '''Write the contents of a finished test to the file'''
+        s = dumps(contents, self.indent)
+        if self.newline is not None:
+            s = s.replace('\n', self.newline)
+        with self.lock:
+            if self.n_written:
+                self.file.write(self.separator)
+            self.file.write(s)
+            self.n_written += 1
 
     def finalize(self, n, time, counts, out, err):
-        self.contents.update(dict(n=n, time=time, counts=counts, out=out, err=err))
+        c = self.contents
+        c['n'], c['time'], c['counts'], c['out'], c['err'] = n, time, counts, out, err
 
     def __exit__(self, value, cls, traceback):
         if self.file is not None:
-            if self.keep_null:
-                contents = self.contents
-            else:
-                contents = self.contents.copy()
-                contents['tests'] = [{k: v for k, v in t.items() if v is not None} for t in contents['tests']]
-            json.dump(contents, self.file, indent=self.indent)
+            rest = {k: v for k, v in self.contents.items() if k != 'compile-info'}
+            doc = dumps(dict(rest, tests=[self.MARK]), self.indent)
+            self.file.write(doc.partition(json.dumps(self.MARK))[2])
+            self.file.flush()
+            detach_writers(self.wrappers)
 
 ################################################################################
 
 class NativeTestReport(Report):
-    def __init__(self, contents, index, args, name):
+    def __init__(self, contents, index, args, name, keep_null=True, callback=None):
         self.contents = contents
+        self.keep_null = keep_null
+        self.callback = callback
         self.contents['name'] = name
         self.contents['index'] = index
         self.contents['args'] = args
-        self.contents['events'] = []
+        self.contents['events'] = None # filled in by finalize()
+        self.events = collections.deque() # (event, scopes, logs) for each call
 
     def __call__(self, event, scopes, logs):
-        self.contents['events'].append(dict(event=Event.name(event), scopes=scopes, logs=logs))
+        self.events.append((event, scopes, logs))
+
+    def materialize_events(self):
+        '''Return the list of event dicts to be serialized'''
+        return [dict(event=EVENT_NAMES[e] if e < N_EVENTS else str(e), scopes=s, logs=l)
+                for e, s, l in self.events]
 
     def finalize(self, value, time, counts, out, err):
-        self.contents.update(dict(value=value, time=time, counts=counts, out=out, err=err))
+        self.contents['events'] = self.materialize_events()
+        self.events = None
+        c = self.contents
+        c['value'], c['time'], c['counts'], c['out'], c['err'] = value, time, counts, out, err
+        if not self.keep_null:
+            for k in [k for k, v in self.contents.items() if v is None]:
+                del self.contents[k]
+        if self.callback is not None:
+            self.callback(self.contents)
 
 ################################################################################
@@ -1,86 +1,125 @@
-from .common import readable_message, Event, Report
+from .common import readable_message, Event, Report, N_EVENTS
+import threading
 
-try:
-    from teamcity.messages import TeamcityServiceMessages
-except ImportError as e:
-    print('teamcity-messages must be installed, e.g. via pip')
-    raise e
+################################################################################
+
+class Duration:
+    '''
+    Minimal stand-in for datetime.timedelta(seconds=time), which is only
+    passed to TeamcityServiceMessages.testFinished() to be converted to milliseconds
+    '''
+    __slots__ = ('days', 'seconds', 'microseconds')
+
+    def __init__(self, time):
+        self.days, self.seconds, self.microseconds = 0, 0, round(time * 1e6)
+
+################################################################################
+
+class BatchWriter:
+    '''
+    File proxy for TeamcityServiceMessages, which flushes after every message.
+    Writes are collected and only written to the file by send().
+    '''
+    def __init__(self, file):
+        # write encoded bytes to the binary buffer of a text file if possible
+        self.file = getattr(file, 'buffer', file)
+        self.text = file if self.file is not file else None
+        self.encoding = (getattr(file, 'encoding', None) or 'utf-8') if self.text is not None else None
+        self.empty = b'' if self.encoding else ''
+        self.parts = []
+        self.lock = threading.Lock()
+
+    def write(self, s):
+        with self.lock:
+            self.parts.append(s)
+
+    def flush(self):
+        pass
+
+    def send(self):
+        '''Write all collected messages to the file at once'''
+        with self.lock:
+            parts, self.parts = self.parts, []
+            if self.text is not None: # keep order with other writes to the text file, e.g. the console
+                self.text.flush()
+            self.file.write(self.empty.join(parts))
+            self.file.flush()
+
+################################################################################
 
-import datetime
+def event_handlers(messages):
+    '''Return tuple of the message function for each Event, or None if it is not reported'''
+    handlers = [None] * N_EVENTS
+    handlers[Event.failure] = handlers[Event.exception] = messages.testFailed
+    handlers[Event.skipped] = messages.testIgnored
+    return tuple(handlers)
 
 ################################################################################
 
 class TeamCityReport(Report):
     '''TeamCity streaming reporter for a test suite'''
     def __init__(self, file, info, sync=True, **kwargs):
-        self.messages = TeamcityServiceMessages(file)
+        try: # imported here so that this module can be imported without it
+            from teamcity.messages import TeamcityServiceMessages
+        except ImportError as e:
+            raise ImportError('teamcity-messages must be installed, e.g. via pip') from e
+        self.writer = BatchWriter(file)
+        self.messages = TeamcityServiceMessages(self.writer, encoding=self.writer.encoding)
+        self.handlers = event_handlers(self.messages)
         self.messages.message('compile-info', name=info[0], date=info[1], time=info[2])
         self.sync = sync
 
     def __call__(self, index, args, info):
-        cls = TeamCityLazyReport if self.sync else TeamCityTestReport
-        return cls(self.messages, args, info[0])
+        # in sync mode, each test's messages are written together when it finishes
+        return TeamCityTestReport(self.messages, args, info[0], self.writer,
+                                  lazy=self.sync, handlers=self.handlers)
 
     def __enter__(self):
         self.messages.testSuiteStarted('default-suite')
+        self.writer.send()
         return self
 
     def __exit__(self, value, cls, traceback):
         self.messages.testSuiteFinished('default-suite')
+        self.writer.send()
 
 ################################################################################
 
 class TeamCityTestReport(Report):
-    '''TeamCity streaming reporter for a test case'''
-    def __init__(self, messages, args, name):
-        self.messages = messages
+    '''
+    TeamCity streaming reporter for a test case
+    If lazy, all messages are deferred until finalize() so that the messages
+    of tests running concurrently are not interleaved.
+    If a BatchWriter is given, the messages written through it are sent at
+    the end of each call. Otherwise they go to the messages' output directly.
+    '''
+    def __init__(self, messages, args, name, writer=None, lazy=False, handlers=None):
+        self.messages, self.writer = messages, writer
+        self.handlers = event_handlers(messages) if handlers is None else handlers
         self.name = name
-        self.messages.testStarted(self.name)
+        self.log = [] if lazy else None
+        if not lazy:
+            self.messages.testStarted(self.name)
+            self.send()
 
     def __call__(self, event, scopes, logs):
-        if event in (Event.failure, Event.exception):
-            f = self.messages.testFailed
-        elif event == Event.skipped:
-            f = self.messages.testSkipped
-        else:
+        f = self.handlers[event] if event < N_EVENTS else None
+        if f is None:
             return
             # maybe use customMessage(self, text, status, errorDetails='', flowId=None):
             # raise ValueError('TeamCity does not handle {}'.format(event))
-        f(self.name, readable_message(event, scopes, logs))
-
-    def finalize(self, value, time, counts, out, err):
-        self.messages.message('counts', errors=str(counts[0]), exceptions=str(counts[2]))
-        if out:
-            self.messages.testStdOut(self.name, out)
-        if err:
-            self.messages.testStdErr(self.name, err)
-        self.messages.testFinished(self.name, testDuration=datetime.timedelta(seconds=time))
-
-
-################################################################################
-
-class TeamCityLazyReport(Report):
-    '''TeamCity streaming reporter for a test case'''
-    def __init__(self, messages, args, name):
-        self.messages = messages
-        self.name = name
-        self.log = []
-
-    def __call__(self, event, scopes, logs):
-        if event in (Event.failure, Event.exception):
-            f = self.messages.testFailed
-        elif event == Event.skipped:
-            f = self.messages.testSkipped
+        if self.log is None: # write immediately so that a crash can be attributed
+            f(self.name, readable_message(event, scopes, logs))
+            self.send()
         else:
-            return
-        self.log.append((f, self.name, readable_message(event, scopes, logs)))
+            self.log.append((f, self.name, readable_message(event, scopes, logs)))
 
     def finalize(self, value, time, counts, out, err):
-        self.messages.testStarted(self.name)
-
-        for f, *args in self.log:
-            f(*args)
-        self.log.clear()
+        if self.log is not None:
+            self.messages.testStarted(self.name)
+            for f, name, message in self.log:
+                f(name, message)
+            self.log.clear()
 
         self.messages.message('counts', errors=str(counts[0]), exceptions=str(counts[2]))
 
@@ -89,6 +128,20 @@ class TeamCityLazyReport(Report):
         if err:
             self.messages.testStdErr(self.name, err)
 
-        self.messages.testFinished(self.name, testDuration=datetime.timedelta(seconds=time))
+        self.messages.testFinished(self.name, testDuration=Duration(time))
+        # with a BatchWriter, the messages above were only collected; write them all in a single call
+        self.send()
+
+    def send(self):
+        '''Write the collected messages if there is a BatchWriter'''
+        if self.writer is not None:
+            self.writer.send()
+
+################################################################################
+
+class TeamCityLazyReport(TeamCityTestReport):
+    '''TeamCity reporter for a test case which defers all messages until finalize()'''
+    def __init__(self, messages, args, name, writer=None):
+        super().__init__(messages, args, name, writer, lazy=True)
 
 ################################################################################
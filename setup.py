@@ -2,7 +2,8 @@ import os
 from setuptools import setup
 
 def read(fname):
-    return open(os.path.join(os.path.dirname(__file__), fname)).read()
+    with open(os.path.join(os.path.dirname(__file__), fname), encoding='utf-8') as f:
+        return f.read()
 
 setup(
     name="lilwil",
@@ -16,6 +17,7 @@ setup(
     download_url = 'https://github.com/mfornace/lilwil/archive/v_01.tar.gz',
     keywords = ['C++', 'unit', 'test'],
     install_requires=['termcolor'],
+    extras_require={'fast': ['orjson']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',